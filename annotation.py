@@ -1,106 +1,144 @@
 import os
-import subprocess
+import shutil
 import tarfile
 import tempfile
+from io import BytesIO
 
-from chord_recognition import chord_recognition
+import av
+import numpy as np
 
+from chord_recognition import ChordRecognizer
+from settings import DEFAULT_SR
 
-def process_tar_mp3s(tar_path, out_dir, chord_dict_name="submission"):
+
+def process_tar_mp3s(tar_path, out_dir, recognizer: ChordRecognizer):
     os.makedirs(out_dir, exist_ok=True)
-    with tarfile.open(tar_path) as tar:
+    # ストリーミングモードで読み、対象外のメンバーは読み込まずに読み飛ばす
+    # 一時ファイルは1つだけ作成し、トラックごとに中身を書き換えて再利用する
+    with tarfile.open(tar_path, mode="r|*") as tar, tempfile.NamedTemporaryFile(
+        suffix=".mp3", delete=True
+    ) as f:
         for m in tar:
-            if m.isfile() and m.name.endswith("other.mp3"):
-                with tempfile.NamedTemporaryFile(suffix=".mp3", delete=True) as f:
-                    f.write(tar.extractfile(m).read())
-                    f.flush()
-                    out_path = os.path.join(
-                        out_dir, os.path.basename(m.name).replace(".mp3", ".lab")
-                    )
-                    chord_recognition(f.name, out_path, chord_dict_name)
+            if not (m.isfile() and m.name.endswith("other.mp3")):
+                continue
+            f.seek(0)
+            f.truncate()
+            # mp3全体をメモリに読み込まず、2MiBずつコピーする
+            shutil.copyfileobj(tar.extractfile(m), f, length=2 << 20)
+            f.flush()
+            out_path = os.path.join(
+                out_dir, os.path.basename(m.name).replace(".mp3", ".lab")
+            )
+            recognizer.recognize_and_save(f.name, out_path)
+
+
+def decode_mp3(data, sr=DEFAULT_SR):
+    """mp3をデコードし、srでサンプリングされたモノラルのfloat32波形として返す"""
+    with av.open(BytesIO(data)) as container:
+        resampler = av.AudioResampler(format="flt", layout="mono", rate=sr)
+        chunks = []
+        for frame in container.decode(audio=0):
+            for out in resampler.resample(frame):
+                chunks.append(out.to_ndarray().reshape(-1))
+        # リサンプラ内部に残ったサンプルを取り出す
+        for out in resampler.resample(None):
+            chunks.append(out.to_ndarray().reshape(-1))
+    if not chunks:
+        return np.zeros(0, dtype=np.float32)
+    return np.concatenate(chunks)
+
+
+def mix_mp3s(other_mp3, bass_mp3, sr=DEFAULT_SR):
+    """2つのmp3をデコードしてミックスし、モノラルのPCM波形として返す
+
+    短い方を無音で延長し、各入力を1/2倍して足し合わせる。ffmpegのamixとは異なり、
+    短い方が終了した後も残りの入力は1/2倍のまま (ゲインを戻さない)。
+    モノラル化はswresampleのダウンミックスで行うため、librosaのチャンネル平均とは
+    厳密には一致しない。
+    """
+    other = decode_mp3(other_mp3, sr)
+    bass = decode_mp3(bass_mp3, sr)
+    mixed = np.zeros(max(len(other), len(bass)), dtype=np.float32)
+    mixed[: len(other)] += other
+    mixed[: len(bass)] += bass
+    mixed *= 0.5
+    return mixed
 
 
-def process_tar_mixed_mp3s(tar_path, out_dir, chord_dict_name="submission"):
+def process_tar_mixed_mp3s(tar_path, out_dir, recognizer: ChordRecognizer):
     os.makedirs(out_dir, exist_ok=True)
-    with tarfile.open(tar_path) as tar:
-        files = {
-            m.name: m
-            for m in tar
-            if m.isfile()
-            and (m.name.endswith("other.mp3") or m.name.endswith("bass.mp3"))
-        }
-        track_ids = set()
-        for name in files:
-            if name.endswith("other.mp3"):
-                track_ids.add(name[:-10])
-
-        print(f"Found {len(track_ids)} tracks with 'other.mp3' files.")
-        for tid in track_ids:
-            other_name = tid + ".other.mp3"
-            bass_name = tid + ".bass.mp3"
-            if other_name in files and bass_name in files:
-                with tempfile.NamedTemporaryFile(suffix=".mp3", delete=True) as f_other:
-                    with tempfile.NamedTemporaryFile(
-                        suffix=".mp3", delete=True
-                    ) as f_bass:
-                        with tempfile.NamedTemporaryFile(
-                            suffix=".mp3", delete=True
-                        ) as f_mix:
-                            f_other.write(tar.extractfile(files[other_name]).read())
-                            f_other.flush()
-                            f_bass.write(tar.extractfile(files[bass_name]).read())
-                            f_bass.flush()
-                            # ffmpegでミックス（mp3出力）
-                            cmd = [
-                                "ffmpeg",
-                                "-y",
-                                "-i",
-                                f_other.name,
-                                "-i",
-                                f_bass.name,
-                                "-filter_complex",
-                                "[0:a][1:a]amix=inputs=2:duration=longest:dropout_transition=0[mix]",
-                                "-map",
-                                "[mix]",
-                                f_mix.name,
-                            ]
-                            subprocess.run(cmd, check=True)
-                            out_path = os.path.join(
-                                out_dir, os.path.basename(tid) + ".lab"
-                            )
-                            chord_recognition(f_mix.name, out_path, chord_dict_name)
+    n_tracks = 0
+    with tarfile.open(tar_path, mode="r:*") as tar:
+        # ヘッダのみを走査し、other/bassのTarInfoをトラックIDごとに集める
+        # ランダムアクセスモードのため、メンバーの中身はシークして読み飛ばされる
+        others = {}
+        basses = {}
+        for m in tar:
+            if not m.isfile():
+                continue
+            if m.name.endswith("other.mp3"):
+                others[m.name[:-10]] = m
+            elif m.name.endswith("bass.mp3"):
+                basses[m.name[:-9]] = m
+
+        # other/bassが揃ったトラックのmp3だけを読み込む
+        for tid, other in others.items():
+            bass = basses.get(tid)
+            if bass is None:
+                continue
+            # デコードしてミックス（PCMをメモリ上で受け渡す）
+            mixed = mix_mp3s(
+                tar.extractfile(other).read(), tar.extractfile(bass).read()
+            )
+            out_path = os.path.join(out_dir, os.path.basename(tid) + ".lab")
+            recognizer.recognize_and_save(mixed, out_path)
+            n_tracks += 1
+
+    print(f"Processed {n_tracks} tracks with 'other.mp3' and 'bass.mp3' files.")
 
 
 if __name__ == "__main__":
+    # モデルのロードは辞書ごとに1回だけ行い、train/testで共有する
+    # CQTはキャッシュされるため、辞書を変えた再実行では推論のみが行われる
+    # 曲ごとに長さが異なるため、cuDNNのアルゴリズム自動選択は使わない
+    # recognizer = ChordRecognizer(
+    #     chord_dict_name="small", cache_cqt=True, cudnn_benchmark=False
+    # )
     # process_tar_mixed_mp3s(
     #     "/data/musdb18hq/train.tar",
     #     "/data/musdb_simple_train",
-    #     "small",
+    #     recognizer,
     # )
     # process_tar_mixed_mp3s(
     #     "/data/musdb18hq/test_ordered.tar",
     #     "/data/musdb_simple_test",
-    #     "small",
+    #     recognizer,
     # )
 
+    # recognizer = ChordRecognizer(
+    #     chord_dict_name="submission", cache_cqt=True, cudnn_benchmark=False
+    # )
     # process_tar_mixed_mp3s(
     #     "/data/musdb18hq/train.tar",
     #     "/data/musdb_large_train",
-    #     "submission",
+    #     recognizer,
     # )
     # process_tar_mixed_mp3s(
     #     "/data/musdb18hq/test_ordered.tar",
     #     "/data/musdb_large_test",
-    #     "submission",
+    #     recognizer,
     # )
 
+    recognizer = ChordRecognizer(
+        chord_dict_name="ismir2017", cache_cqt=True, cudnn_benchmark=False
+    )
     process_tar_mixed_mp3s(
         "/data/musdb18hq/train.tar",
         "/data/musdb_train",
-        "ismir2017",
+        recognizer,
     )
     process_tar_mixed_mp3s(
         "/data/musdb18hq/test_ordered.tar",
         "/data/musdb_test",
-        "ismir2017",
+        recognizer,
     )
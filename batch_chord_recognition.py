@@ -11,16 +11,22 @@ LAB形式のアノテーションを生成します。
 import argparse
 import json
 import logging
+import multiprocessing
+import os
+import queue
 import sys
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
 from pathlib import Path
-from typing import Dict, List
+from typing import Deque, Dict, Iterable, List, Optional, Tuple
 
+import torch
 from tqdm import tqdm
 
 # このディレクトリをパスに追加してインポート可能にする
 sys.path.insert(0, str(Path(__file__).parent))
 
-from chord_recognition import ChordRecognizer
+from chord_recognition import CQT_CACHE_DIR, ChordRecognizer, extract_cqt
 
 # ロギング設定
 logging.basicConfig(
@@ -56,8 +62,60 @@ def parse_args() -> argparse.Namespace:
         choices=["full", "ismir2017", "submission", "extended", "small"],
         help="和音辞書 (デフォルト: small)",
     )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=8,
+        help="1回の推論でまとめて処理するファイル数 (デフォルト: 8)",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=4,
+        help="CQTを計算するワーカープロセス数 (GPUごと, デフォルト: 4)",
+    )
+    parser.add_argument(
+        "--num_gpus",
+        type=int,
+        default=None,
+        help="使用するGPU数 (デフォルト: 利用可能な全GPU)",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="出力LABファイルが既に存在する場合も推定し直す。"
+        "指定しない場合はLABファイルの有無のみを確認するため、"
+        "別の--chord_dictで作成されたLABファイルもスキップされる",
+    )
+    parser.add_argument(
+        "--cache_cqt",
+        action="store_true",
+        help="CQT特徴量をcache_data以下にキャッシュし、再実行時に再利用する",
+    )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default="fp32",
+        choices=["fp32", "fp16", "bf16"],
+        help="推論精度 (デフォルト: fp32)。fp16/bf16はVolta以降のGPUで高速",
+    )
+    parser.add_argument(
+        "--jit",
+        action="store_true",
+        help="torch.jit.traceしたモデルで推論する (トレース結果はcache_dataに保存)",
+    )
+    parser.add_argument(
+        "--cudnn_benchmark",
+        action="store_true",
+        help="cuDNNのアルゴリズム自動選択を有効にする (全ファイルの長さがそろっている場合向け)",
+    )
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.batch_size < 1:
+        parser.error("--batch_size には1以上を指定してください")
+    if args.num_workers < 1:
+        parser.error("--num_workers には1以上を指定してください")
+    return args
 
 
 def find_wav_files(input_dir: Path) -> List[Path]:
@@ -78,49 +136,312 @@ def find_wav_files(input_dir: Path) -> List[Path]:
     return wav_files
 
 
-def estimate_chords_batch(
+def is_complete_lab(lab_path: Path) -> bool:
+    """LABファイルが最後まで書き込まれているかを確認
+
+    LABファイルは一時ファイルに書き込んでから置き換えられるため、
+    空でないファイルが存在すれば完了とみなします。
+    どの和音辞書で推定したファイルかは確認しません。
+
+    Args:
+        lab_path: LABファイルのパス
+
+    Returns:
+        完了したLABファイルであればTrue
+    """
+    try:
+        return lab_path.stat().st_size > 0
+    except OSError:
+        return False
+
+
+def _run_batches(
     recognizer: ChordRecognizer,
-    wav_files: List[Path],
+    batches: Iterable[List[Path]],
     output_dir: Path,
+    num_workers: int,
+    pbar: tqdm,
+    force: bool = False,
+    stats: Optional[Dict] = None,
 ) -> Dict:
-    """バッチで和音推定を実行（モデル常駐版）
+    """バッチを順に取り出して和音推定を実行
+
+    ワーカープロセスで後続のバッチのCQTを先行計算しながら、
+    現在のバッチをGPUでまとめて推論します。バッチは必要になった時点で
+    取り出すため、キューから逐次取り出すイテレータも渡せます。
 
     Args:
         recognizer: 事前ロード済みのChordRecognizerインスタンス
-        wav_files: WAVファイルのパスリスト
+        batches: WAVファイルのパスリストを返すイテラブル
         output_dir: 出力ディレクトリ
+        num_workers: CQTを計算するワーカープロセス数
+        pbar: 進捗表示
+        force: 完了済みのLABファイルがある場合も推定し直すか
+        stats: 更新する実行統計。呼び出し側で用意すると、途中で例外が発生しても
+            それまでの処理結果が残る
 
     Returns:
-        実行統計 (成功数、失敗数など)
+        実行統計 (成功数、失敗数、スキップ数など)
     """
-    stats: Dict = {
-        "total": len(wav_files),
+    if stats is None:
+        stats = merge_stats([])
+
+    def record_error(audio_path: Path, output_path: Path, e: Exception) -> None:
+        tqdm.write(f"❌ エラー ({audio_path.name}): {e}")
+        stats["failed"] += 1
+        stats["errors"].append(
+            {
+                "file": audio_path.name,
+                "output": output_path.name,
+                "error": str(e),
+            }
+        )
+
+    batch_iter = iter(batches)
+
+    if recognizer.cache_cqt:
+        # ワーカー間でキャッシュディレクトリの作成が競合しないよう事前に作成する
+        os.makedirs(CQT_CACHE_DIR, exist_ok=True)
+
+    # CUDA初期化済みのプロセスをforkしないようspawnでワーカーを起動する
+    with ProcessPoolExecutor(
+        max_workers=num_workers, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+
+        def prefetch(depth: int) -> None:
+            # ワーカーが常に稼働するよう、depth個先のバッチまでCQT計算を発行する
+            while len(pending) < depth:
+                batch = next(batch_iter, None)
+                if batch is None:
+                    return
+                if not force:
+                    # 前回の実行で完了済みのファイルは推定しない
+                    remaining = [
+                        path
+                        for path in batch
+                        if not is_complete_lab(output_dir / (path.stem + ".lab"))
+                    ]
+                    n_skipped = len(batch) - len(remaining)
+                    stats["total"] += n_skipped
+                    stats["skipped"] += n_skipped
+                    pbar.update(n_skipped)
+                    batch = remaining
+                    if not batch:
+                        continue
+                futures = [
+                    executor.submit(extract_cqt, path, recognizer.cache_cqt)
+                    for path in batch
+                ]
+                pending.append((batch, futures))
+
+        pending: Deque[Tuple[List[Path], List[Future]]] = deque()
+        prefetch_depth = None
+        prefetch(1)
+        while pending:
+            batch, futures = pending.popleft()
+            stats["total"] += len(batch)
+            if prefetch_depth is None:
+                prefetch_depth = max(1, -(-num_workers // len(batch)))
+            # 後続のバッチのCQT計算を先行して開始
+            prefetch(prefetch_depth)
+
+            # 出力パスの決定
+            output_paths = [output_dir / (path.stem + ".lab") for path in batch]
+
+            ready = []
+            for audio_path, output_path, future in zip(batch, output_paths, futures):
+                try:
+                    entry = recognizer.entry_from_cqt(future.result())
+                    ready.append((audio_path, output_path, entry))
+                except Exception as e:
+                    record_error(audio_path, output_path, e)
+
+            if ready:
+                try:
+                    # 和音推定を実行（モデルは再利用）
+                    chordlabs = recognizer.recognize_batch([r[2] for r in ready])
+                except Exception as e:
+                    for audio_path, output_path, _ in ready:
+                        record_error(audio_path, output_path, e)
+                    chordlabs = []
+
+                for (audio_path, output_path, entry), chordlab in zip(
+                    ready, chordlabs
+                ):
+                    try:
+                        recognizer.save_chordlab(entry, chordlab, output_path)
+                        stats["success"] += 1
+                    except Exception as e:
+                        record_error(audio_path, output_path, e)
+
+            # 次のバッチを待つ間、処理済みのCQTと推定結果を保持しない
+            del futures, ready
+            pbar.update(len(batch))
+
+    return stats
+
+
+def split_batches(wav_files: List[Path], batch_size: int) -> List[List[Path]]:
+    """WAVファイルのリストをbatch_size個ずつに分割"""
+    return [
+        wav_files[i : i + batch_size] for i in range(0, len(wav_files), batch_size)
+    ]
+
+
+def merge_stats(stats_list: List[Dict]) -> Dict:
+    """複数の実行統計を集計"""
+    merged: Dict = {
+        "total": 0,
         "success": 0,
         "failed": 0,
+        "skipped": 0,
         "errors": [],
     }
+    for stats in stats_list:
+        for key in ["total", "success", "failed", "skipped"]:
+            merged[key] += stats[key]
+        merged["errors"].extend(stats["errors"])
+    return merged
+
+
+def estimate_chords_batch(
+    recognizer: ChordRecognizer,
+    wav_files: List[Path],
+    output_dir: Path,
+    batch_size: int = 8,
+    num_workers: int = 4,
+    force: bool = False,
+) -> Dict:
+    """バッチで和音推定を実行（モデル常駐版）
 
+    ワーカープロセスで後続のバッチのCQTを先行計算しながら、
+    現在のバッチをGPUでまとめて推論します。
+
+    Args:
+        recognizer: 事前ロード済みのChordRecognizerインスタンス
+        wav_files: WAVファイルのパスリスト
+        output_dir: 出力ディレクトリ
+        batch_size: 1回の推論でまとめて処理するファイル数
+        num_workers: CQTを計算するワーカープロセス数
+        force: 完了済みのLABファイルがある場合も推定し直すか
+
+    Returns:
+        実行統計 (成功数、失敗数、スキップ数など)
+    """
     logger.info("\n=== 和音推定開始 (総ファイル数: %d) ===" % len(wav_files))
 
-    for audio_path in tqdm(wav_files, desc="和音推定", unit="file"):
-        # 出力パスの決定
-        output_path = output_dir / (audio_path.stem + ".lab")
+    with tqdm(total=len(wav_files), desc="和音推定", unit="file") as pbar:
+        return _run_batches(
+            recognizer,
+            split_batches(wav_files, batch_size),
+            output_dir,
+            num_workers,
+            pbar,
+            force=force,
+        )
+
+
+def build_recognizer(args: argparse.Namespace) -> ChordRecognizer:
+    """コマンドライン引数から和音推定器を初期化（モデルを事前ロード）"""
+    return ChordRecognizer(
+        chord_dict_name=args.chord_dict,
+        verbose=False,
+        cache_cqt=args.cache_cqt,
+        precision=args.precision,
+        use_jit=args.jit,
+        cudnn_benchmark=args.cudnn_benchmark,
+    )
 
-        try:
-            # 和音推定を実行（モデルは再利用）
-            recognizer.recognize_and_save(audio_path, output_path)
-            stats["success"] += 1
-        except Exception as e:
-            tqdm.write(f"❌ エラー ({audio_path.name}): {e}")
-            stats["failed"] += 1
-            stats["errors"].append(
-                {
-                    "file": audio_path.name,
-                    "output": output_path.name,
-                    "error": str(e),
-                }
+
+def gpu_worker(
+    rank: int,
+    args: argparse.Namespace,
+    work_queue: "multiprocessing.Queue",
+    result_queue: "multiprocessing.Queue",
+) -> None:
+    """GPU1枚を担当するワーカー
+
+    自身の和音推定器を持ち、共有キューから空いた順にバッチを取り出して処理します。
+    終了時に実行統計をresult_queueへ送ります。
+    """
+    # 途中で例外が発生しても、それまでに処理したファイルの結果を親プロセスへ送る
+    stats = merge_stats([])
+    try:
+        # CUDAの初期化前に担当GPUのみを見えるようにする
+        # 親プロセスでCUDA_VISIBLE_DEVICESが指定されている場合はその中から選ぶ
+        visible = os.environ.get("CUDA_VISIBLE_DEVICES")
+        device = visible.split(",")[rank] if visible else str(rank)
+        os.environ["CUDA_VISIBLE_DEVICES"] = device
+
+        recognizer = build_recognizer(args)
+        with tqdm(desc="和音推定 (GPU %d)" % rank, unit="file", position=rank) as pbar:
+            _run_batches(
+                recognizer,
+                iter(work_queue.get, None),
+                args.output_dir,
+                args.num_workers,
+                pbar,
+                force=args.force,
+                stats=stats,
             )
+    except Exception as e:
+        # ワーカーが停止しても、残りのバッチは他のGPUが処理する
+        logger.error("GPU %d のワーカーでエラー: %s" % (rank, e))
+    result_queue.put(stats)
+
 
+def estimate_chords_multi_gpu(
+    args: argparse.Namespace, wav_files: List[Path], num_gpus: int
+) -> Dict:
+    """複数GPUで和音推定を実行
+
+    GPUごとにワーカープロセスを起動し、共有キューのバッチを早い者勝ちで処理します。
+
+    Args:
+        args: コマンドライン引数
+        wav_files: WAVファイルのパスリスト
+        num_gpus: 使用するGPU数
+
+    Returns:
+        全ワーカーの実行統計を集計したもの
+    """
+    logger.info(
+        "\n=== 和音推定開始 (総ファイル数: %d, GPU数: %d) ===" % (len(wav_files), num_gpus)
+    )
+
+    ctx = multiprocessing.get_context("spawn")
+    work_queue = ctx.Queue()
+    result_queue = ctx.Queue()
+    for batch in split_batches(wav_files, args.batch_size):
+        work_queue.put(batch)
+    for _ in range(num_gpus):
+        work_queue.put(None)
+
+    processes = [
+        ctx.Process(target=gpu_worker, args=(rank, args, work_queue, result_queue))
+        for rank in range(num_gpus)
+    ]
+    for p in processes:
+        p.start()
+
+    results = []
+    while len(results) < num_gpus:
+        try:
+            results.append(result_queue.get(timeout=1.0))
+        except queue.Empty:
+            # 統計を送らずに異常終了したワーカーがいる場合は待ち続けない
+            if not any(p.is_alive() for p in processes) and result_queue.empty():
+                break
+    for p in processes:
+        p.join()
+    # 全ワーカーが異常終了した場合、未処理のバッチが残っていても終了できるようにする
+    work_queue.cancel_join_thread()
+
+    stats = merge_stats(results)
+    # 成功・スキップしなかったファイル（処理中にワーカーが停止したものや、
+    # 異常終了したワーカーが処理するはずだったもの）は失敗として数える
+    stats["failed"] = len(wav_files) - stats["success"] - stats["skipped"]
+    stats["total"] = len(wav_files)
     return stats
 
 
@@ -145,13 +466,35 @@ def main() -> None:
         logger.error("処理するWAVファイルが見つかりません")
         sys.exit(1)
 
-    # 和音推定器を初期化（モデルを事前ロード）
-    logger.info("モデルをロード中 (和音辞書: %s)..." % args.chord_dict)
-    recognizer = ChordRecognizer(chord_dict_name=args.chord_dict, verbose=False)
-    logger.info("モデルのロード完了")
-
-    # 和音推定を実行
-    stats = estimate_chords_batch(recognizer, wav_files, args.output_dir)
+    available_gpus = torch.cuda.device_count()
+    num_gpus = args.num_gpus
+    if num_gpus is None:
+        num_gpus = available_gpus
+    elif num_gpus > available_gpus:
+        logger.warning(
+            "警告: 指定されたGPU数 (%d) が利用可能なGPU数 (%d) を超えるため、%d に制限します"
+            % (num_gpus, available_gpus, available_gpus)
+        )
+        num_gpus = available_gpus
+
+    if num_gpus > 1:
+        # GPUごとにワーカーを起動して和音推定を実行
+        stats = estimate_chords_multi_gpu(args, wav_files, num_gpus)
+    else:
+        # 和音推定器を初期化（モデルを事前ロード）
+        logger.info("モデルをロード中 (和音辞書: %s)..." % args.chord_dict)
+        recognizer = build_recognizer(args)
+        logger.info("モデルのロード完了")
+
+        # 和音推定を実行
+        stats = estimate_chords_batch(
+            recognizer,
+            wav_files,
+            args.output_dir,
+            batch_size=args.batch_size,
+            num_workers=args.num_workers,
+            force=args.force,
+        )
 
     # 結果を表示
     print("\n" + "=" * 50)
@@ -159,6 +502,9 @@ def main() -> None:
     print("総ファイル数: %d" % stats["total"])
     print("✅ 成功: %d" % stats["success"])
     print("❌ 失敗: %d" % stats["failed"])
+    print("⏭ スキップ (LABファイルが既に存在): %d" % stats["skipped"])
+    if stats["skipped"]:
+        print("  ※ 和音辞書の一致は確認していません。推定し直す場合は--forceを指定してください")
 
     if stats["errors"]:
         print("\n失敗ファイル:")
@@ -1,13 +1,22 @@
+import contextlib
+import functools
+import glob
+import hashlib
+import os
+import pickle
 import sys
+import tempfile
 from pathlib import Path
-from typing import List, Union
+from typing import Callable, Dict, List, Optional, Tuple, Union
 
 import numpy as np
-from chordnet_ismir_naive import ChordNet
+import torch
+from chordnet_ismir_naive import SPEC_DIM, ChordNet
 from extractors.cqt import CQTV2
 from extractors.xhmm_ismir import XHMMDecoder
 from io_new.chordlab_io import ChordLabIO
 from mir import DataEntry, io
+from mir.common import WORKING_PATH
 from mir.nn.train import NetworkInterface
 from settings import DEFAULT_HOP_LENGTH, DEFAULT_SR
 
@@ -15,6 +24,160 @@ MODEL_NAMES = [
     "joint_chord_net_ismir_naive_v1.0_reweight(0.0,10.0)_s%d.best" % i for i in range(5)
 ]
 
+# GPUのキャッシュメモリを解放する間隔 (ファイル数)
+EMPTY_CACHE_INTERVAL = 50
+
+# 推論精度ごとのautocastのdtype (Noneの場合はautocastを使わない)
+PRECISIONS = {
+    "fp32": None,
+    "fp16": torch.float16,
+    "bf16": torch.bfloat16,
+}
+
+# CQT特徴量のキャッシュディレクトリ (mirの抽出器キャッシュの保存先)
+CQT_CACHE_DIR = os.path.join(WORKING_PATH, "cache_data", CQTV2.__name__)
+
+
+@functools.lru_cache(maxsize=8)
+def get_decoder(chord_dict_name: str) -> XHMMDecoder:
+    """和音辞書に対応するHMMデコーダを取得
+
+    和音リストの読み込みは辞書ごとに1回だけ行い、インスタンスを共有します。
+    デコーダは構築後に状態を変更しないため、スレッド間で共有しても安全です。
+
+    Args:
+        chord_dict_name: 和音辞書名 (full, ismir2017, submission, extended, small)
+
+    Returns:
+        XHMMDecoderインスタンス
+    """
+    template_file = (
+        Path(__file__).parent / "data" / ("%s_chord_list.txt" % chord_dict_name)
+    )
+    return XHMMDecoder(template_file=str(template_file))
+
+
+def audio_content_hash(audio: Union[str, Path, np.ndarray]) -> str:
+    """音声ファイルの内容、または波形データのSHA-1ハッシュを計算
+
+    Args:
+        audio: 音声ファイルのパス、または波形
+
+    Returns:
+        16進数表記のハッシュ値
+    """
+    if isinstance(audio, np.ndarray):
+        return hashlib.sha1(np.ascontiguousarray(audio)).hexdigest()
+    sha1 = hashlib.sha1()
+    with open(audio, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def average_probs(probs: List[Tuple[np.ndarray, ...]]) -> List[np.ndarray]:
+    """アンサンブル各モデルの出力確率を平均
+
+    Args:
+        probs: 各モデルの出力 (triad, bass, 7, 9, 11, 13の確率のタプル) のリスト
+
+    Returns:
+        出力ごとに平均した確率のリスト
+    """
+    return [np.mean(np.stack(ps, axis=0), axis=0) for ps in zip(*probs)]
+
+
+def prepare_entry(
+    audio: Union[str, Path, np.ndarray], cache_cqt: bool = False
+) -> DataEntry:
+    """音声ファイルまたは波形からDataEntryを準備
+
+    Args:
+        audio: 音声ファイルのパス、またはDEFAULT_SRでサンプリングされた
+            モノラル波形
+        cache_cqt: CQT特徴量を音声内容のハッシュをキーとしてキャッシュするか
+
+    Returns:
+        CQT特徴量を含むDataEntry
+    """
+    # エントリ名が空の場合、抽出器のキャッシュは無効になる
+    # CQTは和音辞書に依存しないため、音声内容とsr/hop_lengthのみをキーとする
+    name = ""
+    if cache_cqt:
+        name = "%s_sr%d_hop%d" % (
+            audio_content_hash(audio),
+            DEFAULT_SR,
+            DEFAULT_HOP_LENGTH,
+        )
+    entry = DataEntry(name)
+    entry.prop.set("sr", DEFAULT_SR)
+    entry.prop.set("hop_length", DEFAULT_HOP_LENGTH)
+    if isinstance(audio, np.ndarray):
+        entry.append_data(audio, io.MusicIO, "music")
+    else:
+        entry.append_file(str(audio), io.MusicIO, "music")
+    entry.append_extractor(CQTV2, "cqt")
+    return entry
+
+
+def extract_cqt(
+    audio: Union[str, Path, np.ndarray], cache_cqt: bool = False
+) -> np.ndarray:
+    """CQT特徴量を計算
+
+    GPUを使用しないため、ワーカープロセスでの並列計算に使用できます。
+
+    Args:
+        audio: 音声ファイルのパス、またはDEFAULT_SRでサンプリングされた
+            モノラル波形
+        cache_cqt: CQT特徴量を音声内容のハッシュをキーとしてキャッシュするか
+
+    Returns:
+        CQT特徴量 (frames, bins)
+    """
+    entry = prepare_entry(audio, cache_cqt)
+    try:
+        return entry.cqt
+    except Exception as e:
+        if not cache_cqt:
+            raise
+        # 書き込み途中や破損したキャッシュは削除し、キャッシュなしで再計算する
+        print(
+            "[Warning] Unreadable CQT cache for %s, recomputing: %s" % (entry.name, e),
+            file=sys.stderr,
+        )
+        discard_cqt_cache(entry.name)
+        return prepare_entry(audio, False).cqt
+
+
+def discard_cqt_cache(name: str) -> None:
+    """エントリ名に対応するCQTキャッシュを削除
+
+    読み込めない_prop_records.cacheも併せて削除します。
+
+    Args:
+        name: prepare_entryで付与したエントリ名
+    """
+    for cache_path in glob.glob(
+        os.path.join(glob.escape(CQT_CACHE_DIR), "**", "%s*.cache" % glob.escape(name)),
+        recursive=True,
+    ):
+        try:
+            os.remove(cache_path)
+        except OSError:
+            pass
+    prop_cache_path = os.path.join(CQT_CACHE_DIR, "_prop_records.cache")
+    try:
+        with open(prop_cache_path, "rb") as f:
+            pickle.load(f)
+    except FileNotFoundError:
+        pass
+    except Exception:
+        try:
+            os.remove(prop_cache_path)
+        except OSError:
+            pass
+
 
 class ChordRecognizer:
     """和音推定器（モデル常駐版）
@@ -22,24 +185,53 @@ class ChordRecognizer:
     モデルを事前ロードし、複数ファイルの推定時にオーバーヘッドを削減します。
     """
 
-    def __init__(self, chord_dict_name: str = "submission", verbose: bool = False):
+    def __init__(
+        self,
+        chord_dict_name: str = "submission",
+        verbose: bool = False,
+        cache_cqt: bool = False,
+        precision: str = "fp32",
+        use_jit: bool = False,
+        cudnn_benchmark: bool = False,
+    ):
         """初期化
 
         Args:
             chord_dict_name: 和音辞書名 (full, ismir2017, submission, extended, small)
             verbose: 詳細ログを出力するか
+            cache_cqt: CQT特徴量を音声内容のハッシュをキーとして
+                cache_data/CQTV2以下にキャッシュするか
+            precision: 推論精度 (fp32, fp16, bf16)。fp16/bf16ではautocastで推論し、
+                出力確率はfloat32でHMMデコーダに渡す
+            use_jit: torch.jit.traceしたモデルで推論するか。トレース結果は
+                cache_data/<モデル名>.<デバイス>.traced.ptに保存され、次回以降は再利用される
+            cudnn_benchmark: cuDNNの畳み込みアルゴリズムを入力形状ごとに選択するか。
+                新しい形状ごとに選択し直すため、フレーム数がそろった入力でのみ有効。
+                設定は推論中のみ適用し、終了後に元の値へ戻す
         """
+        if precision not in PRECISIONS:
+            raise ValueError(
+                "Unknown precision: %s (expected one of %s)"
+                % (precision, ", ".join(PRECISIONS))
+            )
+        if precision == "bf16" and not (
+            torch.cuda.is_available() and torch.cuda.is_bf16_supported()
+        ):
+            raise ValueError("bf16 precision is not supported on this GPU")
         self.chord_dict_name = chord_dict_name
         self.verbose = verbose
+        self.cache_cqt = cache_cqt
+        self.precision = precision
+        self.use_jit = use_jit
+        self.cudnn_benchmark = cudnn_benchmark
 
-        # HMMデコーダの初期化
-        template_file = (
-            Path(__file__).parent / "data" / ("%s_chord_list.txt" % chord_dict_name)
-        )
-        self.hmm = XHMMDecoder(template_file=str(template_file))
+        # HMMデコーダの初期化（和音辞書ごとに共有）
+        self.hmm = get_decoder(chord_dict_name)
 
         # 5つのアンサンブルモデルを事前ロード
         self.models: List[NetworkInterface] = []
+        # 各モデルの順伝播関数 (use_jitの場合はトレース済みモジュール)
+        self.feeds: List[Callable] = []
         for model_name in MODEL_NAMES:
             if self.verbose:
                 print("Loading model: %s" % model_name)
@@ -47,15 +239,90 @@ class ChordRecognizer:
                 ChordNet(None).cuda(), model_name, load_checkpoint=False
             )
             self.models.append(net)
+            self.feeds.append(self._load_traced(net) if use_jit else net.net.feed)
+
+        # empty_cacheの実行間隔を判定するための処理済みファイル数
+        self._num_processed = 0
+
+        # CQTの転送用ストリーム（推論と転送を重ねるため）
+        self._copy_stream = (
+            torch.cuda.Stream() if self.models[0].net.use_gpu else None
+        )
 
         if self.verbose:
             print("ChordRecognizer initialized with %d models" % len(self.models))
 
-    def _prepare_entry(self, audio_path: Union[str, Path]) -> DataEntry:
-        """音声ファイルからDataEntryを準備
+    def _load_traced(self, net: NetworkInterface) -> torch.jit.ScriptModule:
+        """トレース済みモデルをロード（なければトレースして保存）
+
+        保存済みのトレースが学習済みモデルより古い場合はトレースし直します。
 
         Args:
-            audio_path: 音声ファイルのパス
+            net: ロード済みのモデル
+
+        Returns:
+            ChordNet.forwardをトレースしたモジュール
+        """
+        sdict_path = os.path.join(
+            WORKING_PATH, "cache_data", "%s.sdict" % net.save_name
+        )
+        device = "cuda" if net.net.use_gpu else "cpu"
+        # GPUでトレースするとinit_hiddenの.cuda()が埋め込まれるため、デバイスごとに保存する
+        traced_path = os.path.join(
+            WORKING_PATH, "cache_data", "%s.%s.traced.pt" % (net.save_name, device)
+        )
+        if os.path.isfile(traced_path) and (
+            not os.path.isfile(sdict_path)
+            or os.path.getmtime(traced_path) >= os.path.getmtime(sdict_path)
+        ):
+            if self.verbose:
+                print("Loading traced model: %s" % traced_path)
+            try:
+                return torch.jit.load(traced_path, map_location=device)
+            except Exception as e:
+                # 読み込めないトレースは作り直す
+                print("[Warning] Failed to load %s, re-tracing: %s" % (traced_path, e))
+
+        if self.verbose:
+            print("Tracing model: %s" % net.save_name)
+        # 時間方向の長さは任意でよい（周波数方向のみプーリングされる）
+        dummy = torch.zeros((1, 128, SPEC_DIM), device=device)
+        with torch.no_grad():
+            traced = torch.jit.trace(net.net, dummy)
+
+        # 書き込み途中のファイルを他のプロセスが読まないよう、
+        # 同じディレクトリの一時ファイルに保存してから置き換える
+        fd, temp_path = tempfile.mkstemp(
+            suffix=".traced.pt.tmp", dir=os.path.dirname(traced_path)
+        )
+        os.close(fd)
+        try:
+            torch.jit.save(traced, temp_path)
+            os.replace(temp_path, traced_path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        return traced
+
+    def _prepare_entry(self, audio: Union[str, Path, np.ndarray]) -> DataEntry:
+        """音声ファイルまたは波形からDataEntryを準備
+
+        Args:
+            audio: 音声ファイルのパス、またはDEFAULT_SRでサンプリングされた
+                モノラル波形
+
+        Returns:
+            CQT特徴量を含むDataEntry
+        """
+        return prepare_entry(audio, self.cache_cqt)
+
+    def entry_from_cqt(self, cqt: np.ndarray) -> DataEntry:
+        """計算済みのCQT特徴量からDataEntryを準備
+
+        別プロセスで計算したCQTを推論に渡すために使用します。
+
+        Args:
+            cqt: extract_cqtで計算したCQT特徴量
 
         Returns:
             CQT特徴量を含むDataEntry
@@ -63,10 +330,134 @@ class ChordRecognizer:
         entry = DataEntry()
         entry.prop.set("sr", DEFAULT_SR)
         entry.prop.set("hop_length", DEFAULT_HOP_LENGTH)
-        entry.append_file(str(audio_path), io.MusicIO, "music")
-        entry.append_extractor(CQTV2, "cqt")
+        entry.append_data(cqt, io.SpectrogramIO, "cqt")
         return entry
 
+    def _upload(
+        self, batch: np.ndarray
+    ) -> Tuple[torch.Tensor, Optional[torch.cuda.Event]]:
+        """CQTのバッチをGPUへ非同期に転送
+
+        ページロックメモリから転送用ストリームでnon_blocking転送するため、
+        実行中の推論と転送が重なります。
+
+        Args:
+            batch: 同じフレーム数のCQTを積み重ねた配列 (batch, frames, bins)
+
+        Returns:
+            転送先のテンソルと、転送完了を示すイベント (CPU実行時はNone)
+        """
+        dtype = PRECISIONS[self.precision]
+        # 半精度では転送前に変換し、転送量も半分にする
+        x = torch.from_numpy(batch)
+        if self._copy_stream is None:
+            return x, None
+        if dtype is not None:
+            x = x.to(dtype)
+        x = x.pin_memory()
+        with torch.cuda.stream(self._copy_stream):
+            x = x.to("cuda", non_blocking=True)
+            ready = torch.cuda.Event()
+            ready.record()
+        return x, ready
+
+    def _ensemble_inference(
+        self, x: torch.Tensor, ready: Optional[torch.cuda.Event] = None
+    ) -> List[np.ndarray]:
+        """全モデルで推論し、出力確率のアンサンブル平均を返す
+
+        入力はGPUへ1回だけ転送して全モデルで共有し、平均もGPU上で計算するため、
+        ホストへの転送は出力ごとに1回で済みます。
+
+        Args:
+            x: _uploadで転送したCQTのバッチ (batch, frames, bins)
+            ready: 転送完了を示すイベント
+
+        Returns:
+            出力ごとに平均した確率のリスト (各要素は (batch, frames, classes))
+        """
+        dtype = PRECISIONS[self.precision]
+        use_gpu = self._copy_stream is not None
+        if ready is not None:
+            # 転送用ストリームで確保したテンソルを推論側のストリームで使う
+            torch.cuda.current_stream().wait_event(ready)
+            x.record_stream(torch.cuda.current_stream())
+
+        sums = None
+        # cuDNNの設定はプロセス全体で共有されるため、推論中のみ切り替える
+        prev_benchmark = torch.backends.cudnn.benchmark
+        torch.backends.cudnn.benchmark = self.cudnn_benchmark
+        try:
+            # inference_modeでは勾配記録用のテープやバージョンカウンタを確保しない
+            # fp32ではautocastに入らない (古いtorchはdtype=Noneを受け付けない)
+            if dtype is not None and use_gpu:
+                autocast = torch.autocast("cuda", dtype=dtype)
+            else:
+                autocast = contextlib.nullcontext()
+            with torch.inference_mode(), autocast:
+                for i, (net, feed) in enumerate(zip(self.models, self.feeds)):
+                    if self.verbose:
+                        print("Inference: %s on %d files" % (MODEL_NAMES[i], len(x)))
+                    outputs = net.net.predict_batch(x, feed=feed)
+                    if sums is None:
+                        sums = list(outputs)
+                    else:
+                        sums = [s + o for s, o in zip(sums, outputs)]
+        finally:
+            torch.backends.cudnn.benchmark = prev_benchmark
+        # HMMデコーダでlogを取るため、確率は必ずfloat32に戻す
+        return [(s.float() / len(self.models)).cpu().numpy() for s in sums]
+
+    def recognize_batch(self, entries: List[DataEntry]) -> List[List]:
+        """複数ファイルの和音推定（バッチ推論）
+
+        同じフレーム数のCQTをまとめて1つのバッチとして各モデルに入力します。
+        InstanceNormと双方向LSTMの出力がパディングの影響を受けるため、
+        長さの異なるCQTはゼロパディングせず別のバッチとして推論します。
+
+        Args:
+            entries: CQT特徴量を含むDataEntryのリスト
+
+        Returns:
+            各ファイルの和音ラベルのリスト
+        """
+        # フレーム数ごとにグループ化
+        groups: Dict[int, List[int]] = {}
+        for i, entry in enumerate(entries):
+            groups.setdefault(entry.cqt.shape[0], []).append(i)
+
+        # 全グループの転送を先に発行し、前のグループの推論と重ねる
+        uploads = [
+            self._upload(np.stack([entries[i].cqt for i in indices]))
+            for indices in groups.values()
+        ]
+
+        chordlabs: List = [None] * len(entries)
+        for indices in groups.values():
+            # 推論済みのグループの入力はリストから外し、すぐに解放できるようにする
+            x, ready = uploads.pop(0)
+
+            # アンサンブル推論と確率の平均
+            mean_probs = self._ensemble_inference(x, ready)
+            del x, ready
+
+            for k, i in enumerate(indices):
+                # HMMデコード
+                probs = [p[k] for p in mean_probs]
+                chordlabs[i] = self.hmm.decode_to_chordlab(entries[i], probs, False)
+            del mean_probs, probs
+
+        # 長時間のバッチ処理でキャッシュされたGPUメモリが増え続けないよう、
+        # 一定ファイル数ごとに解放する
+        previous = self._num_processed
+        self._num_processed += len(entries)
+        if self._copy_stream is not None and (
+            self._num_processed // EMPTY_CACHE_INTERVAL
+            > previous // EMPTY_CACHE_INTERVAL
+        ):
+            torch.cuda.empty_cache()
+        return chordlabs
+
     def recognize(self, audio_path: Union[str, Path]) -> List:
         """単一ファイルの和音推定
 
@@ -77,48 +468,56 @@ class ChordRecognizer:
             和音ラベルのリスト [[start, end, chord_name], ...]
         """
         entry = self._prepare_entry(audio_path)
+        return self.recognize_batch([entry])[0]
 
-        # アンサンブル推論
-        probs = []
-        for i, net in enumerate(self.models):
-            if self.verbose:
-                print("Inference: %s on %s" % (MODEL_NAMES[i], audio_path))
-            probs.append(net.inference(entry.cqt))
+    def save_chordlab(
+        self,
+        entry: DataEntry,
+        chordlab: List,
+        lab_path: Union[str, Path],
+        use_entry_save: bool = False,
+    ) -> None:
+        """和音ラベルをLABファイルに保存
 
-        # 確率のアンサンブル平均
-        probs = [np.mean([p[i] for p in probs], axis=0) for i in range(len(probs[0]))]
+        通常はDataEntryを経由せずに直接書き込みます。出力形式はChordLabIOと同一です。
+        <lab_path>.tmpに書き込んでから置き換えるため、lab_pathが存在すれば
+        常に最後まで書き込まれたファイルです。
 
-        # HMMデコード
-        chordlab = self.hmm.decode_to_chordlab(entry, probs, False)
-        return chordlab
+        Args:
+            entry: 推定に用いたDataEntry
+            chordlab: 和音ラベルのリスト
+            lab_path: 出力LABファイルのパス
+            use_entry_save: ChordLabIOとDataEntry.saveを経由して保存するか
+                (出力形式の互換性確認用)
+        """
+        temp_path = str(lab_path) + ".tmp"
+        try:
+            if use_entry_save:
+                entry.append_data(chordlab, ChordLabIO, "chord")
+                entry.save("chord", temp_path)
+            else:
+                with open(temp_path, "w") as f:
+                    f.writelines("%s\t%s\t%s\n" % (s, e, c) for s, e, c in chordlab)
+            os.replace(temp_path, lab_path)
+        except BaseException:
+            # 書き込みに失敗した一時ファイルを残さない
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
 
     def recognize_and_save(
-        self, audio_path: Union[str, Path], lab_path: Union[str, Path]
+        self, audio: Union[str, Path, np.ndarray], lab_path: Union[str, Path]
     ) -> None:
         """和音推定を実行してLABファイルに保存
 
         Args:
-            audio_path: 音声ファイルのパス
+            audio: 音声ファイルのパス、またはDEFAULT_SRでサンプリングされた
+                モノラル波形
             lab_path: 出力LABファイルのパス
         """
-        entry = self._prepare_entry(audio_path)
-
-        # アンサンブル推論
-        probs = []
-        for i, net in enumerate(self.models):
-            if self.verbose:
-                print("Inference: %s on %s" % (MODEL_NAMES[i], audio_path))
-            probs.append(net.inference(entry.cqt))
-
-        # 確率のアンサンブル平均
-        probs = [np.mean([p[i] for p in probs], axis=0) for i in range(len(probs[0]))]
-
-        # HMMデコード
-        chordlab = self.hmm.decode_to_chordlab(entry, probs, False)
-
-        # 保存
-        entry.append_data(chordlab, ChordLabIO, "chord")
-        entry.save("chord", str(lab_path))
+        entry = self._prepare_entry(audio)
+        chordlab = self.recognize_batch([entry])[0]
+        self.save_chordlab(entry, chordlab, lab_path)
 
 
 def chord_recognition(audio_path, lab_path, chord_dict_name="submission"):
@@ -127,7 +526,7 @@ def chord_recognition(audio_path, lab_path, chord_dict_name="submission"):
     注意: この関数は毎回モデルをロードするため、複数ファイル処理には
     ChordRecognizerクラスを使用してください。
     """
-    hmm = XHMMDecoder(template_file="data/%s_chord_list.txt" % chord_dict_name)
+    hmm = get_decoder(chord_dict_name)
     entry = DataEntry()
     entry.prop.set("sr", DEFAULT_SR)
     entry.prop.set("hop_length", DEFAULT_HOP_LENGTH)
@@ -137,8 +536,9 @@ def chord_recognition(audio_path, lab_path, chord_dict_name="submission"):
     for model_name in MODEL_NAMES:
         net = NetworkInterface(ChordNet(None).cuda(), model_name, load_checkpoint=False)
         print("Inference: %s on %s" % (model_name, audio_path))
-        probs.append(net.inference(entry.cqt))
-    probs = [np.mean([p[i] for p in probs], axis=0) for i in range(len(probs[0]))]
+        with torch.inference_mode():
+            probs.append(net.inference(entry.cqt))
+    probs = average_probs(probs)
     chordlab = hmm.decode_to_chordlab(entry, probs, False)
     entry.append_data(chordlab, ChordLabIO, "chord")
     entry.save("chord", lab_path)
@@ -187,6 +187,18 @@ class ChordNet(NetworkBehavior):
         result_13=F.softmax(output[5],dim=1).cpu().numpy()
         return result_triad,result_bass,result_7,result_9,result_11,result_13
 
+    def predict_batch(self, x, feed=None):
+        # x: (batch_size, seq_length, feature_dim); all sequences must share the same length
+        # since InstanceNorm and the backward LSTM would see any zero padding
+        # feed: optional replacement of self.feed, e.g. a traced copy of this network
+        # returns the softmax outputs as tensors on the device of x
+        batch_size=x.shape[0]
+        seq_length=x.shape[1]
+        if(feed is None):
+            feed=self.feed
+        output=feed(x[:,:,SHIFT_HIGH*SHIFT_STEP:SHIFT_HIGH*SHIFT_STEP+SPEC_DIM])
+        return tuple(F.softmax(o,dim=1).view((batch_size,seq_length,-1)) for o in output)
+
 class ChordNetCNN(NetworkBehavior):
 
     def __init__(self,cross_subpart_counter):